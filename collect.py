@@ -3,21 +3,59 @@
 
 # constants
 RELEASE = 'v0.3.0'
-ARCGIS_JSON_URL = 'https://services.arcgis.com/ORpvigFPJUhb8RDF/arcgis/rest/services/corona_DD_7_Sicht/FeatureServer/0/query?f=pjson&where=ObjectId>=0&outFields=*'
+ARCGIS_JSON_URL = 'https://services.arcgis.com/ORpvigFPJUhb8RDF/arcgis/rest/services/corona_DD_7_Sicht/FeatureServer/0/query?f=json&where=ObjectId>=0&outFields=*' # 'f=json': compact JSON without line breaks and indentation, which is smaller and can be archived as it is
 GITHUB_JSON_URL = 'https://raw.githubusercontent.com/jdieg0/coronavirus-dresden-data/main/latest-json' # points to a JSON file that has been checked by maintainers for errors committed by the city
+DOWNLOAD_TIMEOUT = 30 # seconds to wait for the server, so that a hanging connection does not block the next cron runs
 CACHED_JSON_FILENAME = 'cached.json'
+CACHED_HASH_FILENAME = 'cached.json.hash' # hash of the raw data of the cached JSON file, used for a fast check for changes
+CACHED_ETAG_FILENAME = 'cached.json.etag' # ETag sent by the server along with the cached JSON file, used to let the server check for changes
+CREATED_DATABASE_FILENAME = 'influxdb_created' # flag file that marks that the InfluxDB database has already been created; delete it if the database has been dropped
 OUTPUT_FOLDER = 'output'
 JSON_ARCHIVE_FOLDER = 'data'
 
+DATE_FORMAT = '%d.%m.%Y' # format of the field 'Datum' in the data set, e. g. '22.10.2020'
+PUB_DATE_FORMATS = ('%Y-%m-%dT%H:%M:%SZ', '%Y-%m-%dT%H%M%SZ') # expected formats of publishing dates passed with '--date' (e. g. '2020-10-18T09:52:41Z') or read from file names of archived JSON files (e. g. '2020-10-18T095241Z')
+
 INFLUXDB_DATABASE = 'corona_dd'
 INFLUXDB_MEASUREMENTS = ['dresden_official', 'dresden_official_all'] # all measurements to be saved
 INFLUXDB_MEASUREMENT_ARCHIVE = 'dresden_official_all' # measurement that contains all series (latest of the day as well as all corrections by the city)
+INFLUXDB_FIELD_SPEC = ( # numeric fields taken over from the data source: (name, data type, value used if the original value is None or 0); fields with a value of None are not written; the table is compiled into a function with 'exec' (see compile_fields_builder()), so defaults must be literals that can be written with repr()
+    ('BelegteBetten'                    , int   , 0),
+    ('Datum_neu'                        , int   , 0),
+    ('Fallzahl'                         , int   , 0),
+    ('Fallzahl_aktiv'                   , int   , 0),
+    ('Fallzahl_aktiv_Zuwachs'           , int   , 0),
+    ('Fälle_Meldedatum'                 , int   , 0),
+    ('Genesungsfall'                    , int   , 0),
+    ('Hospitalisierung'                 , int   , 0),
+    ('Hosp_Meldedatum'                  , int   , 0),
+    ('Inzidenz'                         , float , 0.0),
+    ('Inzi_SN_RKI'                      , float , None),
+    ('Inzidenz_RKI'                     , float , None),
+    ('Krh_I'                            , int   , 0),
+    ('Krh_I_belegt'                     , int   , 0),
+    ('Krh_I_covid'                      , int   , 0),
+    ('Krh_I_frei'                       , int   , 0),
+    ('Krh_N'                            , int   , 0),
+    ('Krh_N_belegt'                     , int   , 0),
+    ('Krh_N_frei'                       , int   , 0),
+    ('Mutation'                         , int   , None),
+    ('ObjectId'                         , int   , 0),
+    ('Sterbefall'                       , int   , 0),
+    ('SterbeF_Meldedatum'               , int   , 0),
+    ('SterbeF_Sterbedatum'              , int   , 0),
+    ('Zuwachs_Fallzahl'                 , int   , 0),
+    ('Zuwachs_Genesung'                 , int   , 0),
+    ('Zuwachs_Krankenhauseinweisung'    , int   , 0),
+    ('Zuwachs_Mutation'                 , int   , None),
+    ('Zuwachs_Sterbefall'               , int   , 0),
+)
+INFLUXDB_STRING_FIELDS = ('Anzeige_Indikator', 'Datum', 'Vorz_akt_Faelle', 'Zeitraum') # fields taken over from the data source as strings ('Anzeige_Indikator' is either 'None' or 'x')
+INFLUXDB_BATCH_SIZE = 5000 # maximum number of points sent to InfluxDB per HTTP request, 5000 is recommended as optimal batch size; https://docs.influxdata.com/influxdb/v1.8/concepts/glossary/#batch
+INFLUXDB_UDP_PAYLOAD_SIZE = 65507 # maximum number of bytes sent to InfluxDB per UDP packet (maximum payload of a UDP packet over IPv4)
 
 import sys
 
-# debugging
-from IPython import embed
-
 # command line arguments
 import argparse
 
@@ -28,25 +66,236 @@ import logging.handlers
 # paths
 import pathlib
 
+# files
+import os
+import mmap
+
 # JSON
-import urllib.request
+import requests
+import urllib.parse
+import hashlib
 import json
+try:
+    import orjson # considerably faster (de)serialisation of the large JSON data set; https://github.com/ijl/orjson
+except ImportError:
+    orjson = None # fall back to the standard library
 
 # date parsing
-import dateutil.parser
-import datetime
-
-# dicts
-import copy
+import datetime # 'dateutil' is only imported if needed
 
 # database
-from influxdb import InfluxDBClient
+import functools # 'influxdb' is only imported if needed
+
+def download(url, etag=None):
+    """Downloads a file and returns the response; compressed transfer is negotiated automatically by 'requests'.
+
+    If the ETag of a previous download is given, the server only sends the file again if it has changed in the meantime, otherwise it answers with status code 304 (not modified).
+    """
+    headers = {'If-None-Match': etag} if etag else None
+    response = http_session.get(url, headers=headers, timeout=DOWNLOAD_TIMEOUT)
+    response.raise_for_status()
+    return response
+
+def file_equals(path, raw_data):
+    """Checks whether a file has exactly the given content. The file is memory-mapped, so that it does not have to be read into memory for the comparison.
+    """
+    try:
+        with open(path, 'rb') as file:
+            if os.fstat(file.fileno()).st_size != len(raw_data):
+                return False
+            if not raw_data:
+                return True # empty files cannot be mapped
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped_file, memoryview(mapped_file) as file_content:
+                return file_content == raw_data
+    except FileNotFoundError:
+        return False
+
+def save_cache(cached_json_path, raw_data, data_hash, etag):
+    """Caches the raw data as it is (instead of serialising the parsed data again), along with its hash and ETag.
+    """
+    pathlib.Path.mkdir(output_dir, parents=True, exist_ok=True)
+    write_file_atomically(cached_json_path, raw_data)
+    save_cache_metadata(data_hash, etag)
+
+def save_cache_metadata(data_hash, etag):
+    """Saves hash and ETag (if sent by the server) belonging to the cached JSON file. An outdated ETag is removed, so that it cannot match a later version of the data.
+    """
+    pathlib.Path(output_dir, CACHED_HASH_FILENAME).write_text(data_hash)
+    cached_etag_path = pathlib.Path(output_dir, CACHED_ETAG_FILENAME)
+    if etag:
+        cached_etag_path.write_text(etag)
+    else:
+        try:
+            cached_etag_path.unlink()
+        except FileNotFoundError:
+            pass
+
+def write_file_atomically(path, content):
+    """Writes bytes to a temporary file first and renames it afterwards, so that an interrupted run never leaves a partially written file behind.
+    """
+    temp_path = path.with_name(path.name + '.tmp')
+    temp_path.write_bytes(content)
+    os.replace(temp_path, path) # atomic on POSIX and Windows; https://docs.python.org/3/library/os.html#os.replace
+
+def load_json(raw):
+    """Deserialises JSON data given as bytes or string, using 'orjson' if available.
+    """
+    if orjson:
+        return orjson.loads(raw)
+    return json.loads(raw)
+
+def dump_json(data, indent=None):
+    """Serialises data to UTF-8 encoded JSON bytes, using 'orjson' if available. Only an indentation of 2 spaces is supported.
+    """
+    if orjson:
+        return orjson.dumps(data, option=orjson.OPT_INDENT_2 if indent else None)
+    return json.dumps(data, indent=indent).encode('utf-8')
+
+def parse_date(date_string):
+    """Parses a date from the data set as UTC. The expected format is tried first, as this is much faster than the generic parser of 'dateutil'.
+    """
+    try:
+        date = datetime.datetime.strptime(date_string, DATE_FORMAT)
+    except ValueError:
+        import dateutil.parser
+        date = dateutil.parser.parse(date_string, dayfirst=True) # fallback in case the city changes the format
+    return date.replace(tzinfo=datetime.timezone.utc)
+
+@functools.lru_cache(maxsize=None)
+def date_to_seconds(date_string):
+    """Returns the UNIX timestamp in seconds of a date from the data set. The results are cached, so that a date is parsed and converted only once per run.
+
+    Dates in exactly the expected format 'DD.MM.YYYY' are split up directly, since strptime() is implemented in pure Python; 'datetime.date' checks that day and month exist. All other dates are parsed by parse_date().
+    """
+    date_parts = date_string.split('.')
+    if [len(date_part) for date_part in date_parts] == [2, 2, 4] and ''.join(date_parts).isdigit():
+        day, month, year = date_parts
+        try:
+            return (datetime.date(int(year), int(month), int(day)).toordinal() - 719163) * 24*60*60 # 719163: ordinal of the UNIX epoch 1970-01-01
+        except ValueError:
+            pass # e. g. '31.02.2021', handled by parse_date()
+    return int(parse_date(date_string).timestamp())
+
+def parse_pub_date(date_string):
+    """Parses a publishing date. The expected formats are tried first, so that 'dateutil' only has to be imported for other formats. Raises ValueError if the date cannot be parsed.
+    """
+    for date_format in PUB_DATE_FORMATS:
+        try:
+            return datetime.datetime.strptime(date_string, date_format).replace(tzinfo=datetime.timezone.utc)
+        except ValueError:
+            pass
+    import dateutil.parser
+    return dateutil.parser.parse(date_string) # 'dateutil.parser.ParserError' is a subclass of ValueError
+
+def compile_fields_builder():
+    """Generates a function that adds the fields of INFLUXDB_FIELD_SPEC and INFLUXDB_STRING_FIELDS from the attributes of a data point to a fields dict.
+
+    The loops over the field specification are unrolled once per run, so that they are not repeated for every single point.
+    """
+    namespace = {}
+    source = ['def build_fields(attributes, fields):', '    get = attributes.get']
+    for i, (name, data_type, default) in enumerate(INFLUXDB_FIELD_SPEC):
+        converter_name = 'convert_{:d}'.format(i)
+        namespace[converter_name] = data_type # converters are passed by reference, so that any callable can be used, not only builtins
+        source.append('    value = get({!r})'.format(name))
+        source.append('    fields[{!r}] = {:s}(value) if value else {!r}'.format(name, converter_name, default))
+    for name in INFLUXDB_STRING_FIELDS:
+        source.append('    fields[{0!r}] = str(get({0!r}))'.format(name))
+    exec('\n'.join(source), namespace)
+    return namespace['build_fields']
+
+@functools.lru_cache(maxsize=None) # the same few keys are escaped over and over again
+def escape_key(key):
+    """Escapes a measurement name, tag key, tag value or field key for the InfluxDB line protocol.
+    """
+    return key.replace('\\', '\\\\').replace(' ', '\\ ').replace(',', '\\,').replace('=', '\\=').replace('\n', '\\n')
+
+@functools.lru_cache(maxsize=None)
+def format_field_key(key):
+    """Returns the escaped field key followed by '=', i. e. the constant part of a field in line protocol.
+    """
+    return escape_key(key) + '='
+
+def format_field_value(value):
+    """Formats a field value for the InfluxDB line protocol according to its data type.
+    """
+    if isinstance(value, str):
+        return '"{:s}"'.format(value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+    elif isinstance(value, bool):
+        return 'true' if value else 'false'
+    elif isinstance(value, int):
+        return '{:d}i'.format(value) # integer fields need an 'i' suffix, otherwise they are stored as float
+    else:
+        return repr(float(value))
+
+def format_series(measurement, tags):
+    """Returns the series key (measurement and tag set) of a point in line protocol; tags are sorted by key as recommended by InfluxDB.
+    """
+    return ','.join([escape_key(measurement)] + ['{:s}={:s}'.format(escape_key(key), escape_key(value)) for key, value in sorted(tags.items())])
+
+def format_point(fields, time):
+    """Returns field set and timestamp of a point in line protocol, i. e. everything but the series key; fields without a value (None) are omitted. https://docs.influxdata.com/influxdb/v1.8/write_protocols/line_protocol_reference/
+    """
+    return '{:s} {:d}'.format(','.join([format_field_key(key) + format_field_value(value) for key, value in fields.items() if value is not None]), time)
+
+def format_line(series, fields, time):
+    """Returns a point in line protocol.
+    """
+    return '{:s} {:s}'.format(series, format_point(fields, time))
+
+def format_series_lines(points):
+    """Converts points that all belong to the same series (same measurement and tags) to line protocol.
+
+    The series key is formatted only once instead of for every single point by the InfluxDB client.
+    """
+    series = format_series(points[0]['measurement'], points[0]['tags'])
+    return [format_line(series, point['fields'], point['time']) for point in points]
+
+def write_lines(lines):
+    """Writes points in line protocol to InfluxDB, in as few requests as the batch size allows.
+    """
+    if args.udp_port:
+        send_lines_udp(lines)
+    else:
+        from influxdb.exceptions import InfluxDBClientError
+
+        try:
+            db_client.write_points(lines, time_precision='s', batch_size=INFLUXDB_BATCH_SIZE, protocol='line')
+        except InfluxDBClientError as error:
+            if 'database not found' not in str(error):
+                raise
+            # the database has been dropped since it was created by this script, so create it again
+            db_client.create_database(INFLUXDB_DATABASE)
+            db_client.write_points(lines, time_precision='s', batch_size=INFLUXDB_BATCH_SIZE, protocol='line')
+
+def send_lines_udp(lines):
+    """Sends points in line protocol to InfluxDB via UDP, split into as few packets as the maximum payload size allows. Lines exceeding this size on their own are written via HTTP instead.
+    """
+    packet = []
+    packet_size = 0
+    for line in lines:
+        line_size = len(line.encode('utf-8')) + 1 # including line break
+        if line_size > INFLUXDB_UDP_PAYLOAD_SIZE:
+            db_client.write(line, params={'db': INFLUXDB_DATABASE, 'precision': 's'}, protocol='line')
+            continue
+        if packet_size + line_size > INFLUXDB_UDP_PAYLOAD_SIZE:
+            db_client.send_packet(packet, protocol='line')
+            packet = []
+            packet_size = 0
+        packet.append(line)
+        packet_size += line_size
+    if packet:
+        db_client.send_packet(packet, protocol='line')
 
 def setup():
-    """Performs some basic configuration regarding logging, command line options, database etc.
+    """Performs some basic configuration regarding logging, command line options etc.
     """
+    # resolve the path of this script only once
+    global script_path
+    script_path = pathlib.Path(__file__).resolve()
+
     # derive log file name from script name
-    log_filename = '{}{:s}'.format(pathlib.Path(__file__).resolve().stem, '.log')
+    log_filename = '{}{:s}'.format(script_path.stem, '.log')
 
     # read command line arguments (https://docs.python.org/3/howto/argparse.html)
     argparser = argparse.ArgumentParser(description='Collects official SARS-CoV-2 infection statistics published by the city of Dresden.')
@@ -56,10 +305,11 @@ def setup():
     arg_group_outputs.add_argument('-a', '--archive-json', help='archive JSON file each time new data is found or force-collected', action='store_true')
     argparser.add_argument('-c', '--force-collect', help='store JSON data, regardless of whether new data points have been found or not', action='store_true')
     arg_group_timestamps.add_argument('-d', '--date', help='set publishing date manually for the new data set, e. g. \'2020-10-18T09:52:41Z\'')
-    arg_group_inputs.add_argument('-f', '--file', help='load JSON data from a local file instead from server; if no publishing date is passed with the \'--date\' or \'--auto-date\' option, an attempt is made to read the date from the filename', nargs='?', type=argparse.FileType('r'), const='query.json') # 'const' is used, if '--file' is passed without an argument; default=sys.stdin; https://stackoverflow.com/a/15301183/7192373
+    arg_group_inputs.add_argument('-f', '--file', help='load JSON data from a local file instead from server; if no publishing date is passed with the \'--date\' or \'--auto-date\' option, an attempt is made to read the date from the filename', nargs='?', type=argparse.FileType('rb'), const='query.json') # 'const' is used, if '--file' is passed without an argument; default=sys.stdin; https://stackoverflow.com/a/15301183/7192373
     arg_group_outputs.add_argument('-l', '--log', help='save log in file \'{:s}\''.format(log_filename), action='store_true')
     arg_group_outputs.add_argument('-n', '--no-cache', help='suppress the saving of a JSON cache file (helpful if you do not want to mess with an active cron job looking for changes)', action='store_true')
-    arg_group_outputs.add_argument('-o', '--output-dir', help='set a user defined directory where data (cache, logs and JSONs) are stored; default: directory of this Python script', default=pathlib.Path(pathlib.Path(__file__).resolve().parent, OUTPUT_FOLDER)) # use absolute path of this Python folder as default directory
+    arg_group_outputs.add_argument('-o', '--output-dir', help='set a user defined directory where data (cache, logs and JSONs) are stored; default: directory of this Python script', default=pathlib.Path(script_path.parent, OUTPUT_FOLDER)) # use absolute path of this Python folder as default directory
+    arg_group_outputs.add_argument('-p', '--udp-port', help='send data points to InfluxDB via UDP on this port instead of HTTP, which is faster but gives no feedback on errors; requires an InfluxDB UDP listener for database \'{:s}\' with precision \'s\''.format(INFLUXDB_DATABASE), type=int)
     arg_group_outputs.add_argument('-s', '--skip-influxdb', help='check for and write new JSON data only, do not write to InfluxDB', action='store_true')
     arg_group_timestamps.add_argument('-t', '--auto-date', help='do not try to to parse the publishing date from the filename, instead write current date (UTC) to database', action='store_true')
     arg_group_inputs.add_argument('-u', '--url', help='URL to be used to check for JSON updates; default: \'arcgis\'', choices=['arcgis', 'github'], default='arcgis', type=str.lower)
@@ -101,77 +351,120 @@ def setup():
         handler.setFormatter(log_formatter)
         logger.addHandler(handler)
 
-    # setup DB connection
-    if not args.skip_influxdb:
-        global db_client
-        db_client = InfluxDBClient(host='localhost', port=8086) # https://www.influxdata.com/blog/getting-started-python-influxdb/
+    # reuse one HTTP session (and connection) for all downloads
+    global http_session
+    http_session = requests.Session()
+    http_session.headers['User-Agent'] = 'coronavirus-dresden/{:s}'.format(RELEASE) # identify this script to the servers; compressed transfer ('Accept-Encoding: gzip, deflate') is requested by default
+
+def connect_influxdb():
+    """Sets up the DB connection. This is only done if there is data to be written, so that the import of 'influxdb' is saved on all other runs.
+    """
+    from influxdb import InfluxDBClient
+
+    global db_client
+    db_client = InfluxDBClient(host='localhost', port=8086, database=INFLUXDB_DATABASE, use_udp=bool(args.udp_port), udp_port=args.udp_port or 4444) # https://www.influxdata.com/blog/getting-started-python-influxdb/; UDP: https://docs.influxdata.com/influxdb/v1.8/supported_protocols/udp/
+
+    # create the database only once instead of sending a request on every run
+    created_database_path = pathlib.Path(output_dir, CREATED_DATABASE_FILENAME)
+    if not created_database_path.exists():
         db_client.create_database(INFLUXDB_DATABASE)
-        db_client.switch_database(INFLUXDB_DATABASE)
+        pathlib.Path.mkdir(output_dir, parents=True, exist_ok=True)
+        created_database_path.touch()
 
 def main():
     setup()
 
-    # load locally cached JSON file
-    cached_json_path = pathlib.Path(output_dir, CACHED_JSON_FILENAME).resolve()
-    try:
-        with open(cached_json_path, 'r') as json_file:
-            cached_data = json.load(json_file)
-    except FileNotFoundError:
-        cached_data = None
-        logger.debug('File \'{:s}\' not found.'.format(CACHED_JSON_FILENAME))
-
     # load (possibly) new JSON data and write it to InfluxDB
+    etag = None
     if args.file:
-        data = json.load(args.file)
-        logger.debug('Read JSON data from local file \'{:s}\'.'.format(args.file.name))
+        raw_data = args.file.read()
+        logger.debug('Read JSON data from local file \'%s\'.', args.file.name)
     else:
         # choose right URL to JSON file
         if args.url == 'arcgis':
             json_url = ARCGIS_JSON_URL
-            with urllib.request.urlopen(json_url) as response:
-                data = json.load(response)
-                logger.debug(f'Downloaded JSON data from server \'ArcGIS\'.')
+            server_name = 'ArcGIS'
         else:
             symlink_url = GITHUB_JSON_URL
             # read relative path to latest JSON
-            with urllib.request.urlopen(symlink_url) as response:
-                symlink = response.read().decode('utf-8')
-                json_url = urllib.parse.urljoin(symlink_url, symlink) # put together the full JSON URL
-            # open the JSON itself
-            with urllib.request.urlopen(json_url) as response:
-                data = json.load(response)
-                logger.debug(f'Downloaded JSON data from server \'GitHub\'.')
-   
+            symlink = download(symlink_url).content.decode('utf-8')
+            json_url = urllib.parse.urljoin(symlink_url, symlink) # put together the full JSON URL
+            server_name = 'GitHub'
+
+        # send the ETag of the cached data, so that the server does not need to send the JSON file again if it has not changed (conditional request); https://developer.mozilla.org/en-US/docs/Web/HTTP/Headers/If-None-Match
+        cached_etag_path = pathlib.Path(output_dir, CACHED_ETAG_FILENAME).resolve()
+        try:
+            cached_etag = None if args.force_collect else cached_etag_path.read_text()
+        except FileNotFoundError:
+            cached_etag = None
+            logger.debug('File \'%s\' not found.', CACHED_ETAG_FILENAME)
+        # open the JSON itself
+        response = download(json_url, etag=cached_etag)
+        if response.status_code == requests.codes.not_modified:
+            logger.info('Data has not changed.')
+            return
+        raw_data = response.content
+        etag = response.headers.get('ETag')
+        logger.debug('Downloaded JSON data from server \'%s\'.', server_name)
+
+    # compare the hash of the raw data with the hash of the cached data first, so that neither of the JSON files has to be parsed if nothing has changed
+    data_hash = hashlib.blake2b(raw_data, digest_size=16).hexdigest()
+    cached_hash_path = pathlib.Path(output_dir, CACHED_HASH_FILENAME).resolve()
+    cached_json_path = pathlib.Path(output_dir, CACHED_JSON_FILENAME).resolve()
+    try:
+        cached_hash = cached_hash_path.read_text()
+        data_unchanged = data_hash == cached_hash
+    except FileNotFoundError:
+        cached_hash = None
+        logger.debug('File \'%s\' not found.', CACHED_HASH_FILENAME)
+        data_unchanged = file_equals(cached_json_path, raw_data) # compare the raw data with the cached file itself instead
+    if data_unchanged and not args.force_collect:
+        logger.info('Data has not changed.')
+        # the server sent the same data with a new ETag or the hash is missing, so remember them
+        if (etag or not cached_hash) and not args.no_cache:
+            save_cache_metadata(data_hash, etag)
+        return
+    data = load_json(raw_data)
+
+    # load locally cached JSON file
+    try:
+        with open(cached_json_path, 'rb') as json_file:
+            cached_data = load_json(json_file.read())
+    except FileNotFoundError:
+        cached_data = None
+        logger.debug('File \'%s\' not found.', CACHED_JSON_FILENAME)
+
     # get current date from system and latest entry date from the data set
     data_load_date = datetime.datetime.now(tz=datetime.timezone.utc)
     midnight = data_load_date.replace(hour = 0, minute = 0, second = 0, microsecond = 0)
-    data_latest_date = datetime.datetime.fromtimestamp(data['features'][-1]['attributes']['Datum_neu']/1000, tz=datetime.timezone.utc) # date from last entry in data set
+    data_latest_date = datetime.datetime.fromtimestamp(data['features'][-1]['attributes']['Datum_neu'] // 1000, tz=datetime.timezone.utc) # date from last entry in data set
     try:
-        cached_data_latest_date = datetime.datetime.fromtimestamp(cached_data['features'][-1]['attributes']['Datum_neu']/1000, tz=datetime.timezone.utc)
+        cached_data_latest_date = datetime.datetime.fromtimestamp(cached_data['features'][-1]['attributes']['Datum_neu'] // 1000, tz=datetime.timezone.utc)
     except TypeError:
         cached_data_latest_date = datetime.datetime(1970, 1, 1) # use default date if no cached data is available
     # check whether downloaded JSON contains new data or user enforced data collection 
     if data == cached_data and not args.force_collect:
         logger.info('Data has not changed.')
+        # only the formatting of the data differs, so cache the new raw data, so that it matches the new hash
+        if not args.no_cache:
+            save_cache(cached_json_path, raw_data, data_hash, etag)
     else:
+        data_is_from_today = data_latest_date >= midnight
         if data != cached_data:
             # check whether data contains a new or updated day
-            if data_latest_date >= midnight and data_latest_date != cached_data_latest_date:
-                data_change = 'added'
-                logger.info('New data for today has been found!')
-            elif data_latest_date >= midnight and data_latest_date == cached_data_latest_date:
-                data_change = 'updated'
-                logger.info('Updated data for today has been found!')
-            elif data_latest_date < midnight and data_latest_date != cached_data_latest_date:
-                data_change = 'added'
-                logger.info('New data for a previous day has been found!')
-            elif data_latest_date < midnight and data_latest_date == cached_data_latest_date:
-                data_change = 'updated'
-                logger.info('Updated data for a previous day has been found!')
+            data_change = 'updated' if data_latest_date == cached_data_latest_date else 'added'
+            data_change_messages = {
+                #(data_change, data_is_from_today)  : log message
+                ('added', True)                     : 'New data for today has been found!',
+                ('updated', True)                   : 'Updated data for today has been found!',
+                ('added', False)                    : 'New data for a previous day has been found!',
+                ('updated', False)                  : 'Updated data for a previous day has been found!',
+            }
+            logger.info(data_change_messages[data_change, data_is_from_today])
         else:
             # '--force-collect'
             data_change = 'updated'
-            if data_latest_date >= midnight:
+            if data_is_from_today:
                 logger.info('Data for today has not been changed, but is nevertheless collected as requested.')
             else:
                 logger.info('Data for a previous day has not been changed, but is nevertheless collected as requested.')
@@ -179,8 +472,8 @@ def main():
         # save query date
         if args.date:
             try:
-                data_load_date = dateutil.parser.parse(args.date) # use user's publishing date if given for the new data set
-            except dateutil.parser.ParserError:
+                data_load_date = parse_pub_date(args.date) # use user's publishing date if given for the new data set
+            except ValueError:
                 logger.error('Failed to parse publishing date \'{:s}\'.'.format(args.date))
                 sys.exit()
         elif (args.file or args.url == 'github') and not args.auto_date:
@@ -190,18 +483,19 @@ def main():
                 json_filename = pathlib.Path(json_url.rsplit('/', 1)[-1]).stem # read date from name of linked file on GitHub
             
             try:
-                data_load_date = dateutil.parser.parse(json_filename) # try to parse the filename as date, if '--auto-date' option is set or data is loaded downloaded from server
-            except dateutil.parser.ParserError:
-                logger.error('Failed to parse the publishing date \'{:s}\' from filename. Please rename the file so that it has a valid date format or use the \'--date\' option to specify the date or pass \'--auto-date\' to save the current time as the publishing date for this time series. For further help type \'python {} --help\'.'.format(json_filename, pathlib.Path(__file__).resolve().name))
+                data_load_date = parse_pub_date(json_filename) # try to parse the filename as date, if '--auto-date' option is set or data is loaded downloaded from server
+            except ValueError:
+                logger.error('Failed to parse the publishing date \'{:s}\' from filename. Please rename the file so that it has a valid date format or use the \'--date\' option to specify the date or pass \'--auto-date\' to save the current time as the publishing date for this time series. For further help type \'python {} --help\'.'.format(json_filename, script_path.name))
                 sys.exit()
         # else:
             # loaded from file with '--auto-date' option or downloaded from ArcGIS server
 
-        # cache JSON file
-        if not args.no_cache:
-            pathlib.Path.mkdir(output_dir, parents=True, exist_ok=True)
-            with open(cached_json_path, 'w') as json_file:
-                json.dump(data, json_file, indent=2)
+        # format the publishing date only once, it is used for the archive file name as well as in InfluxDB
+        data_load_date_str = data_load_date.strftime('%Y-%m-%dT%H:%M:%S')
+
+        # connect to InfluxDB not until new data is to be written
+        if not args.skip_influxdb:
+            connect_influxdb()
 
         # archive JSON file
         if args.archive_json:
@@ -211,144 +505,122 @@ def main():
                 'json'          : None, # save JSON without line breaks and indentation for better processing performance; https://geobern.blogspot.com/2017/02/the-difference-between-json-and-pjson.html
                 'pjson'         : 2, # make JSON human readable by pretty printing
             }
+            archive_dir = pathlib.Path(output_dir, JSON_ARCHIVE_FOLDER)
+            archive_filename = '{:s}Z.json'.format(data_load_date_str.replace(':', '')) # the same for all styles, e. g. '2020-10-18T095241Z.json'
             for folder, indent in json_styles.items():
-                archive_file_dir = pathlib.Path(output_dir, JSON_ARCHIVE_FOLDER, folder)
-                pathlib.Path.mkdir(archive_file_dir, parents=True, exist_ok=True)
-                archive_file_path = pathlib.Path(archive_file_dir, '{:s}.json'.format(data_load_date.strftime('%Y-%m-%dT%H%M%SZ')))
-                with open(archive_file_path, 'w') as json_file:
-                    json.dump(data, json_file, indent=indent)
+                archive_file_dir = archive_dir / folder
+                archive_file_dir.mkdir(parents=True, exist_ok=True)
+                archive_file_path = archive_file_dir / archive_filename
+                if indent is None and b'\n' not in raw_data.rstrip():
+                    archive_data = raw_data # the raw data is already compact (e. g. as downloaded from ArcGIS), so it does not have to be serialised again
+                else:
+                    archive_data = dump_json(data, indent=indent)
+                write_file_atomically(archive_file_path, archive_data)
 
         if args.skip_influxdb:
+            # cache JSON file
+            if not args.no_cache:
+                save_cache(cached_json_path, raw_data, data_hash, etag)
             logger.info('Skipping writing to InfluxDB.')
             sys.exit()
 
         # define tags of the time series
-        influxdb_pub_date = data_load_date # date on which the record was published
         influxdb_tag_latest_date_short = data_latest_date # shorter version for graph legend aliases in Grafana; https://grafana.com/docs/grafana/latest/datasources/influxdb/#alias-patterns
         influxdb_field_latest_date = data_latest_date
         influxdb_tag_script_version = RELEASE # state version number of this script
 
+        # format the dates only once, they are the same for all points
+        influxdb_pub_date_str = data_load_date_str # date on which the record was published
+        influxdb_tag_latest_date_short_ymd = influxdb_tag_latest_date_short.strftime('%Y-%m-%d')
+        influxdb_tag_latest_date_short_dmy = influxdb_tag_latest_date_short.strftime('%d.%m.%Y')
+        influxdb_field_latest_date_seconds = int(influxdb_field_latest_date.timestamp())
+        build_fields = compile_fields_builder()
+
+        influxdb_lines = [] # all points in line protocol, written to the database at once
+        time_series = []
+        time_series_2 = []
+
+        # 'python' measurement
+        python_measurement_metadata = {
+            'measurement'   : 'python',
+            'tags'          : {
+                'data_version'  : 'noon',
+                },
+        }
+        cases_processed_series = []
+        cases_reported_series = []
+
+        # metadata for the data points
+        tags = {
+            '01_latest_date_short_ymd'  : influxdb_tag_latest_date_short_ymd, # other date format that is sorted correctly by InfluxDB; '01': display this tag first in InfluxDB queries
+            'latest_date_short'         : influxdb_tag_latest_date_short_dmy, # more accurate name for the date used
+            'pub_date_short'            : influxdb_tag_latest_date_short_dmy, # legacy name for the date of the latest time series entry, not actually the publishing date
+            'script_version'            : influxdb_tag_script_version,
+        }
+
         # generate time series list according to the expected InfluxDB line protocol: https://docs.influxdata.com/influxdb/v1.8/write_protocols/line_protocol_tutorial/
-        for influx_db_measurement in INFLUXDB_MEASUREMENTS:
-            time_series = []
-            time_series_2 = []
-
-            # 'python' measurement
-            python_measurement_metadata = {
-                'measurement'   : 'python',
-                'tags'          : {
-                    'data_version'  : 'noon',
-                    },
+        # the points are the same for all measurements, only measurement name and tags differ, so they are generated only once
+        for point in data['features']:
+            attributes = point['attributes']
+            time_seconds = date_to_seconds(attributes['Datum'])
+            point_dict = {
+                'tags'          : tags, # the same dict for all points, it is not modified
+                'time'          : time_seconds, # UNIX timestamp in seconds of the date 'Datum' at midnight UTC (InfluxDB uses UTC)
+                'fields'        : { # in principle, a simple "point.pop('attributes')" also works, but unfortunately the field datatype is defined by the first point written to a series (in case of this foreign data set, some fields are filled with NoneType); https://github.com/influxdata/influxdb/issues/3460#issuecomment-124747104
+                    # own fields
+                    'pub_date'                      : influxdb_pub_date_str,
+                    'pub_date_seconds'              : influxdb_field_latest_date_seconds, # legacy name, same as 'latest_date_seconds'
+                    'latest_date_seconds'           : influxdb_field_latest_date_seconds, # add better searchable UNIX timestamp in seconds in addition to the human readable 'latest_date_short' tag; https://docs.influxdata.com/influxdb/v2.0/reference/glossary/#unix-timestamp; POSIX timestamps in Python: https://stackoverflow.com/a/8778548/7192373
+                },
             }
-            cases_processed_series = []
-            cases_reported_series = []
-
-            for point in data['features']:
-                #if influx_db_measurement == 'dresden_official_shifted':
-                #    time = dateutil.parser.parse(point['attributes']['Datum'], dayfirst=True).replace(tzinfo=datetime.timezone.utc) + datetime.timedelta(days=1)
-                #else:
-                #   time = dateutil.parser.parse(point['attributes']['Datum'], dayfirst=True).replace(tzinfo=datetime.timezone.utc)
-                time = dateutil.parser.parse(point['attributes']['Datum'], dayfirst=True).replace(tzinfo=datetime.timezone.utc)
-                point_dict = {
-                    'measurement'   : influx_db_measurement,
-                    'tags'          : { # metadata for the data point
-                        '01_latest_date_short_ymd'  : influxdb_tag_latest_date_short.strftime('%Y-%m-%d'), # other date format that is sorted correctly by InfluxDB; '01': display this tag first in InfluxDB queries
-                        'latest_date_short'         : influxdb_tag_latest_date_short.strftime('%d.%m.%Y'), # more accurate name for the date used
-                        'pub_date_short'            : influxdb_tag_latest_date_short.strftime('%d.%m.%Y'), # legacy name for the date of the latest time series entry, not actually the publishing date
-                        'script_version'            : influxdb_tag_script_version,
-                    },
-                    'time'          : int(time.timestamp()), # parse date, switch month and day, explicetely set UTC (InfluxDB uses UTC), otherwise local timezone is assumed; 'datetime.datetime.isoformat()': generate ISO 8601 formatted string (e. g. '2020-10-22T21:30:13.883657+00:00')
-                    'fields'        : { # in principle, a simple "point.pop('attributes')" also works, but unfortunately the field datatype is defined by the first point written to a series (in case of this foreign data set, some fields are filled with NoneType); https://github.com/influxdata/influxdb/issues/3460#issuecomment-124747104
-                        # own fields
-                        'pub_date'                      : influxdb_pub_date.strftime('%Y-%m-%dT%H:%M:%S'),
-                        'pub_date_seconds'              : int(influxdb_field_latest_date.timestamp()), # legacy name, same as 'latest_date_seconds'
-                        'latest_date_seconds'           : int(influxdb_field_latest_date.timestamp()), # add better searchable UNIX timestamp in seconds in addition to the human readable 'latest_date_short' tag; https://docs.influxdata.com/influxdb/v2.0/reference/glossary/#unix-timestamp; POSIX timestamps in Python: https://stackoverflow.com/a/8778548/7192373
-                        'Meldedatum_or_Zuwachs'         : int(point['attributes'].get('Fälle_Meldedatum', point['attributes']['Zuwachs_Fallzahl']) or 0), # Get the field 'Fälle_Meldedatum' that was introduced by the city on 29.10.2020, for older data sets use the field 'Zuwachs_Fallzahl'
-                        # fields from data source
-                        'Anzeige_Indikator'             : str(point['attributes'].get('Anzeige_Indikator')), # value is either None or 'x'
-                        'BelegteBetten'                 : int(point['attributes'].get('BelegteBetten') or 0), # replace NoneType with 0
-                        'Datum'                         : str(point['attributes'].get('Datum')),
-                        'Datum_neu'                     : int(point['attributes'].get('Datum_neu') or 0),
-                        'Fallzahl'                      : int(point['attributes'].get('Fallzahl') or 0),
-                        'Fallzahl_aktiv'                : int(point['attributes'].get('Fallzahl_aktiv') or 0),
-                        'Fallzahl_aktiv_Zuwachs'        : int(point['attributes'].get('Fallzahl_aktiv_Zuwachs') or 0),
-                        'Fälle_Meldedatum'              : int(point['attributes'].get('Fälle_Meldedatum') or 0),
-                        'Genesungsfall'                 : int(point['attributes'].get('Genesungsfall') or 0),
-                        'Hospitalisierung'              : int(point['attributes'].get('Hospitalisierung') or 0),
-                        'Hosp_Meldedatum'               : int(point['attributes'].get('Hosp_Meldedatum') or 0),
-                        'Inzidenz'                      : float(point['attributes'].get('Inzidenz') or 0),
-                        'Inzi_SN_RKI'                   : float(point['attributes'].get('Inzi_SN_RKI')) if point['attributes'].get('Inzi_SN_RKI') else None,
-                        'Inzidenz_RKI'                  : float(point['attributes'].get('Inzidenz_RKI')) if point['attributes'].get('Inzidenz_RKI') else None, # convert only to float if value is not None
-                        'Krh_I'                         : int(point['attributes'].get('Krh_I') or 0),
-                        'Krh_I_belegt'                  : int(point['attributes'].get('Krh_I_belegt') or 0),
-                        'Krh_I_covid'                   : int(point['attributes'].get('Krh_I_covid') or 0),
-                        'Krh_I_frei'                    : int(point['attributes'].get('Krh_I_frei') or 0),
-                        'Krh_N'                         : int(point['attributes'].get('Krh_N') or 0),
-                        'Krh_N_belegt'                  : int(point['attributes'].get('Krh_N_belegt') or 0),
-                        'Krh_N_frei'                    : int(point['attributes'].get('Krh_N_frei') or 0),
-                        'Mutation'                      : int(point['attributes'].get('Mutation')) if point['attributes'].get('Mutation') else None,
-                        'ObjectId'                      : int(point['attributes'].get('ObjectId') or 0),
-                        'Sterbefall'                    : int(point['attributes'].get('Sterbefall') or 0),
-                        'SterbeF_Meldedatum'            : int(point['attributes'].get('SterbeF_Meldedatum') or 0),
-                        'SterbeF_Sterbedatum'           : int(point['attributes'].get('SterbeF_Sterbedatum') or 0),
-                        'Vorz_akt_Faelle'               : str(point['attributes'].get('Vorz_akt_Faelle')),
-                        'Zeitraum'                      : str(point['attributes'].get('Zeitraum')),
-                        'Zuwachs_Fallzahl'              : int(point['attributes'].get('Zuwachs_Fallzahl') or 0),
-                        'Zuwachs_Genesung'              : int(point['attributes'].get('Zuwachs_Genesung') or 0),
-                        'Zuwachs_Krankenhauseinweisung' : int(point['attributes'].get('Zuwachs_Krankenhauseinweisung') or 0),
-                        'Zuwachs_Mutation'              : int(point['attributes'].get('Zuwachs_Mutation')) if point['attributes'].get('Zuwachs_Mutation') else None,
-                        'Zuwachs_Sterbefall'            : int(point['attributes'].get('Zuwachs_Sterbefall') or 0),
-                    },
-                }
+            # fields from data source
+            fields = point_dict['fields']
+            build_fields(attributes, fields)
+            # Get the field 'Fälle_Meldedatum' that was introduced by the city on 29.10.2020, for older data sets use the field 'Zuwachs_Fallzahl'; both have already been converted above
+            fields['Meldedatum_or_Zuwachs'] = fields['Fälle_Meldedatum'] if 'Fälle_Meldedatum' in attributes else fields['Zuwachs_Fallzahl']
 
-                if influx_db_measurement == INFLUXDB_MEASUREMENT_ARCHIVE:
-                    # save every time series, including all corrections of the city of the same day, in an separate InfluxDB measurement, distiguishable by a 'pub_date' tag (containing exact date and time)
-                    point_dict['tags']['pub_date'] = influxdb_pub_date.strftime('%Y-%m-%dT%H:%M:%SZ')
-                
-                # save point to time series/measurement
-                time_series.append(point_dict)
-
-                # backdated processed cases 0-24 o'clock; save in point_dict2/time_series2
-                previous_day = time - datetime.timedelta(days=1)
-                cases_processed_by_date = {
-                    'time'      : int(previous_day.timestamp()),
-                    'fields'    : {
-                        'Fallzahl_Meldedatum'                   : point_dict['fields']['Fallzahl'] - point_dict['fields']['Meldedatum_or_Zuwachs'], # calculate the actual number of cases without the report of the following day by 12 noon
-                    },
-                }
-
-                # copy point_dict and overwrite 'time' and 'fields' (preserve tags)
-                point_dict2 = copy.deepcopy(point_dict)
-                point_dict2.update(cases_processed_by_date) # take the old dict as a template and overwrite fields with only this single field
-                time_series_2.append(point_dict2)
-
-                # save also for later for the 'python' measurement
-                cases_processed_series.append(cases_processed_by_date) # 'Fallzahl_Meldedatum' minus today's cases shifted to yesterday
-                # 'Fallzahl_Meldedatum' column only
-                field_changes =  {
-                    'fields'    : {
-                        'Meldedatum_or_Zuwachs_zuletzt_importiert'  : point_dict['fields']['Meldedatum_or_Zuwachs'],
-                    },
-                }
-                cases_reported_by_date = copy.deepcopy(point_dict)
-                cases_reported_by_date.update(python_measurement_metadata)
-                cases_reported_by_date.update(field_changes)
-                cases_reported_series.append(cases_reported_by_date)
-
-            # add today's reported cases (until 12 o'clock)
+            # save point to time series/measurement
+            time_series.append(point_dict)
+
+            # backdated processed cases 0-24 o'clock; save in time_series_2
             cases_processed_by_date = {
-                'time'      : int(time.timestamp()),
+                'time'      : time_seconds - 24*60*60, # previous day; UTC has no daylight saving time, so every day has the same number of seconds
                 'fields'    : {
-                    'Fallzahl_Meldedatum'   : point_dict['fields']['Fallzahl'],
+                    'Fallzahl_Meldedatum'                   : point_dict['fields']['Fallzahl'] - point_dict['fields']['Meldedatum_or_Zuwachs'], # calculate the actual number of cases without the report of the following day by 12 noon
                 },
             }
-            point_dict2 = copy.deepcopy(point_dict) # copy last point_dict of the 'for' loop
-            point_dict2.update(cases_processed_by_date) # overwrite dict with 'time' and 'fields'
-            time_series_2.append(point_dict2)
+            time_series_2.append(cases_processed_by_date) # only 'time' and this single field are needed, the series key is added when formatting the points; InfluxDB merges it with the other fields of the series at that time
 
-            # write data to database
-            db_client.write_points(time_series, time_precision='s')
-            db_client.write_points(time_series_2, time_precision='s')
+            # save also for later for the 'python' measurement
+            cases_processed_series.append(cases_processed_by_date) # 'Fallzahl_Meldedatum' minus today's cases shifted to yesterday
+            # 'Fallzahl_Meldedatum' column only
+            field_changes =  {
+                'fields'    : {
+                    'Meldedatum_or_Zuwachs_zuletzt_importiert'  : point_dict['fields']['Meldedatum_or_Zuwachs'],
+                },
+            }
+            cases_reported_by_date = {**python_measurement_metadata, 'time': time_seconds, **field_changes}
+            cases_reported_series.append(cases_reported_by_date)
+
+        # add today's reported cases (until 12 o'clock)
+        cases_processed_by_date = {
+            'time'      : time_seconds,
+            'fields'    : {
+                'Fallzahl_Meldedatum'   : point_dict['fields']['Fallzahl'],
+            },
+        }
+        time_series_2.append(cases_processed_by_date)
+
+        # format the points only once and prepend the series key of each measurement
+        for series_points in (time_series, time_series_2):
+            points_formatted = [format_point(point['fields'], point['time']) for point in series_points]
+            for influx_db_measurement in INFLUXDB_MEASUREMENTS:
+                measurement_tags = tags
+                if influx_db_measurement == INFLUXDB_MEASUREMENT_ARCHIVE:
+                    # save every time series, including all corrections of the city of the same day, in an separate InfluxDB measurement, distiguishable by a 'pub_date' tag (containing exact date and time)
+                    measurement_tags = dict(tags, pub_date=influxdb_pub_date_str + 'Z')
+                series = format_series(influx_db_measurement, measurement_tags)
+                influxdb_lines += [series + ' ' + point_formatted for point_formatted in points_formatted]
 
         # do own calculations
         # measurement that contains the daily 12 pm reports (last point of each day)
@@ -363,7 +635,7 @@ def main():
         time_series_latest['fields'].update(field_changes)
         # replace measurement name and tags (dict depth = 0)
         time_series_latest.update(python_measurement_metadata) # add metadata
-        db_client.write_points([time_series_latest], time_precision='s')
+        influxdb_lines += format_series_lines([time_series_latest])
 
         # add value for the reported cases of the data set published on the following day (so that the public health office had 36 h time to count them instead of 12 h)
         point_day_before = time_series[-2]
@@ -374,16 +646,23 @@ def main():
             },
         }
         point_day_before.update(fields_overwrite)
-        db_client.write_points([point_day_before], time_precision='s')
+        influxdb_lines += format_series_lines([point_day_before])
         
         # 'Fallzahl_Meldedatum' minus today's cases shifted to yesterday
         cases_processed_series_previous_day = cases_processed_series[-1]
         cases_processed_series_previous_day.update(python_measurement_metadata)
-        db_client.write_points([cases_processed_series_previous_day], time_precision='s')
+        influxdb_lines += format_series_lines([cases_processed_series_previous_day])
+
+        influxdb_lines += format_series_lines(cases_reported_series)
 
-        db_client.write_points(cases_reported_series, time_precision='s')
+        # write data to database
+        write_lines(influxdb_lines)
+
+        # cache JSON file not until the data has been written, so that it is collected again by the next run if the database is not available
+        if not args.no_cache:
+            save_cache(cached_json_path, raw_data, data_hash, etag)
 
-        series_key = 'latest_date_short={:s},script_version={:s}'.format(influxdb_tag_latest_date_short.strftime('%d.%m.%Y'), influxdb_tag_script_version) # https://docs.influxdata.com/influxdb/v1.8/concepts/glossary/#series-key
+        series_key = 'latest_date_short={:s},script_version={:s}'.format(influxdb_tag_latest_date_short_dmy, influxdb_tag_script_version) # https://docs.influxdata.com/influxdb/v1.8/concepts/glossary/#series-key
 
         if data_change == 'added':
             logger.info('Time series with tags \'{:s}\' successfully added to database.'.format(series_key))